@@ -1,10 +1,15 @@
 import streamlit as st
 import pandas as pd
 import numpy as np
-from datetime import datetime, date
+from datetime import datetime, date, time as dt_time
+import bisect
 import json
+import os
+import time
+import unicodedata
 import uuid
 import random
+import threading
 
 # Configuración de la página
 st.set_page_config(
@@ -187,10 +192,288 @@ class SistemaIA:
         
         return mensajes
 
+class DiarioEventos:
+    """Diario append-only de eventos con confirmación por lotes y snapshots periódicos"""
+    
+    def __init__(self, directorio='datos', tamano_lote=20, intervalo_lote=2.0, intervalo_snapshot=200):
+        self.ruta_diario = os.path.join(directorio, 'diario.jsonl')
+        self.directorio_snapshots = os.path.join(directorio, 'snapshots')
+        os.makedirs(self.directorio_snapshots, exist_ok=True)
+        
+        self.tamano_lote = tamano_lote
+        self.intervalo_lote = intervalo_lote
+        self.intervalo_snapshot = intervalo_snapshot
+        
+        self.pendientes = []
+        self.inicio_lote = None
+        self.secuencia = 0
+        # Bytes del diario ya aplicados al estado en memoria
+        self.offset = 0
+        self.eventos_desde_snapshot = 0
+        # Índice ordenado de snapshots: (instante, secuencia, ruta)
+        self.snapshots = self.listar_snapshots()
+    
+    def listar_snapshots(self):
+        """Indexar los snapshots existentes a partir del nombre de fichero"""
+        snapshots = []
+        for nombre in os.listdir(self.directorio_snapshots):
+            if not (nombre.startswith('snapshot_') and nombre.endswith('.json')):
+                continue
+            _, secuencia, instante = nombre[:-len('.json')].split('_')
+            snapshots.append((
+                datetime.strptime(instante, "%Y%m%dT%H%M%S%f"),
+                int(secuencia),
+                os.path.join(self.directorio_snapshots, nombre)
+            ))
+        return sorted(snapshots)
+    
+    @staticmethod
+    def serializar(valor):
+        """Serializar fechas para JSON"""
+        if isinstance(valor, (datetime, date)):
+            return valor.isoformat()
+        raise TypeError(f"Tipo no serializable: {type(valor).__name__}")
+    
+    @staticmethod
+    def aplicar_evento(incidencias, evento):
+        """Aplicar un evento sobre una lista de incidencias"""
+        tipo = evento['tipo']
+        datos = evento['datos']
+        
+        if tipo == 'incidencia_creada':
+            incidencia = dict(datos['incidencia'])
+            if isinstance(incidencia.get('fecha_creacion'), str):
+                incidencia['fecha_creacion'] = datetime.fromisoformat(incidencia['fecha_creacion'])
+            incidencias.append(incidencia)
+        elif tipo in ('incidencia_cerrada', 'prevision_actualizada'):
+            for incidencia in incidencias:
+                if incidencia['id'] == datos['id']:
+                    incidencia.update(datos['cambios'])
+                    break
+        # 'mensajes_generados' solo queda registrado, no modifica el estado
+    
+    def registrar(self, tipo, datos, usuario=None):
+        """Añadir un evento al lote pendiente y confirmarlo si el lote está lleno"""
+        self.secuencia += 1
+        evento = {
+            'seq': self.secuencia,
+            'ts': datetime.now().isoformat(),
+            'tipo': tipo,
+            'usuario': usuario,
+            'datos': datos
+        }
+        self.pendientes.append(json.dumps(evento, default=self.serializar, ensure_ascii=False))
+        
+        if self.inicio_lote is None:
+            self.inicio_lote = time.monotonic()
+        if (len(self.pendientes) >= self.tamano_lote
+                or time.monotonic() - self.inicio_lote >= self.intervalo_lote):
+            self.confirmar()
+        return evento
+    
+    def confirmar(self):
+        """Escribir el lote pendiente en el diario con una única escritura y fsync"""
+        if not self.pendientes:
+            return
+        with open(self.ruta_diario, 'ab') as f:
+            f.write(('\n'.join(self.pendientes) + '\n').encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+            self.offset = f.tell()
+        self.eventos_desde_snapshot += len(self.pendientes)
+        self.pendientes = []
+        self.inicio_lote = None
+    
+    def necesita_snapshot(self):
+        """Indicar si se han acumulado suficientes eventos desde el último snapshot"""
+        return not self.pendientes and self.eventos_desde_snapshot >= self.intervalo_snapshot
+    
+    def tomar_snapshot(self, incidencias):
+        """Guardar un snapshot compacto del estado confirmado"""
+        self.confirmar()
+        instante = datetime.now()
+        nombre = f"snapshot_{self.secuencia:010d}_{instante.strftime('%Y%m%dT%H%M%S%f')}.json"
+        ruta = os.path.join(self.directorio_snapshots, nombre)
+        
+        contenido = {
+            'seq': self.secuencia,
+            'ts': instante.isoformat(),
+            'offset': self.offset,
+            'incidencias': incidencias
+        }
+        # Escritura atómica: fichero temporal y renombrado
+        with open(ruta + '.tmp', 'w', encoding='utf-8') as f:
+            json.dump(contenido, f, default=self.serializar, ensure_ascii=False, separators=(',', ':'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(ruta + '.tmp', ruta)
+        
+        self.snapshots.append((instante, self.secuencia, ruta))
+        self.eventos_desde_snapshot = 0
+    
+    def cargar_snapshot(self, ruta):
+        """Cargar un snapshot y devolver (incidencias, secuencia, offset)"""
+        with open(ruta, encoding='utf-8') as f:
+            contenido = json.load(f)
+        incidencias = []
+        for incidencia in contenido['incidencias']:
+            self.aplicar_evento(incidencias, {'tipo': 'incidencia_creada', 'datos': {'incidencia': incidencia}})
+        return incidencias, contenido['seq'], contenido['offset']
+    
+    def leer_eventos(self, offset=0):
+        """Leer los eventos del diario a partir de un offset en bytes"""
+        if not os.path.exists(self.ruta_diario):
+            return
+        with open(self.ruta_diario, 'rb') as f:
+            f.seek(offset)
+            for linea in f:
+                if not linea.endswith(b'\n'):
+                    # Registro final sin salto de línea: escritura parcial tras una caída
+                    break
+                try:
+                    evento = json.loads(linea.decode('utf-8'))
+                except (UnicodeDecodeError, json.JSONDecodeError) as error:
+                    raise ValueError(f"Evento corrupto en '{self.ruta_diario}' (offset {offset})") from error
+                offset += len(linea)
+                yield evento, offset
+    
+    def recuperar(self):
+        """Reconstruir el estado desde el último snapshot y reproducir solo la cola"""
+        incidencias, secuencia, offset = [], 0, 0
+        if self.snapshots:
+            incidencias, secuencia, offset = self.cargar_snapshot(self.snapshots[-1][2])
+        
+        reproducidos = 0
+        for evento, offset in self.leer_eventos(offset):
+            self.aplicar_evento(incidencias, evento)
+            secuencia = evento['seq']
+            reproducidos += 1
+        
+        # Lo que queda tras el último evento completo es un registro parcial
+        if os.path.exists(self.ruta_diario) and os.path.getsize(self.ruta_diario) > offset:
+            with open(self.ruta_diario, 'r+b') as f:
+                f.truncate(offset)
+        
+        self.secuencia = secuencia
+        self.offset = offset
+        self.eventos_desde_snapshot = reproducidos
+        return incidencias
+    
+    def estado_en(self, instante):
+        """Reconstruir las incidencias confirmadas tal como estaban en un instante dado"""
+        incidencias, offset = [], 0
+        snapshots = list(self.snapshots)
+        posicion = bisect.bisect_right([s[0] for s in snapshots], instante)
+        if posicion:
+            incidencias, _, offset = self.cargar_snapshot(snapshots[posicion - 1][2])
+        
+        # Un único escritor registra en orden: 'seq', orden del fichero y 'ts' coinciden,
+        # así que la reproducción termina en el primer evento posterior al instante
+        for evento, _ in self.leer_eventos(offset):
+            if datetime.fromisoformat(evento['ts']) > instante:
+                break
+            self.aplicar_evento(incidencias, evento)
+        return incidencias
+
+class IndiceEspacial:
+    """Índice de rejilla sobre coordenadas (latitud, longitud) para búsquedas por radio"""
+    
+    RADIO_TIERRA_KM = 6371.0
+    LATITUD_REFERENCIA = 41.7  # Centro aproximado de Catalunya
+    
+    def __init__(self, coordenadas, tamano_celda_km=5.0):
+        self.coordenadas = np.asarray(coordenadas, dtype=float).reshape(-1, 2)
+        self.tamano_celda_km = tamano_celda_km
+        self.celdas = {}
+        
+        if len(self.coordenadas):
+            claves = np.floor(self.proyectar(self.coordenadas) / tamano_celda_km).astype(int)
+            unicas, inversa = np.unique(claves, axis=0, return_inverse=True)
+            orden = np.argsort(inversa.ravel(), kind='stable')
+            limites = np.cumsum(np.bincount(inversa.ravel(), minlength=len(unicas)))[:-1]
+            for clave, indices in zip(unicas, np.split(orden, limites)):
+                self.celdas[tuple(clave)] = indices
+    
+    @classmethod
+    def proyectar(cls, coordenadas):
+        """Proyección equirectangular a km, suficiente a escala de Catalunya"""
+        coordenadas = np.asarray(coordenadas, dtype=float).reshape(-1, 2)
+        km_por_grado = np.pi * cls.RADIO_TIERRA_KM / 180
+        return np.column_stack([
+            coordenadas[:, 1] * km_por_grado * np.cos(np.radians(cls.LATITUD_REFERENCIA)),
+            coordenadas[:, 0] * km_por_grado
+        ])
+    
+    @classmethod
+    def distancia_km(cls, lat, lon, coordenadas):
+        """Distancia haversine desde un punto a un array de coordenadas"""
+        coordenadas = np.radians(np.asarray(coordenadas, dtype=float).reshape(-1, 2))
+        lat, lon = np.radians(lat), np.radians(lon)
+        a = (np.sin((coordenadas[:, 0] - lat) / 2) ** 2
+             + np.cos(lat) * np.cos(coordenadas[:, 0]) * np.sin((coordenadas[:, 1] - lon) / 2) ** 2)
+        return 2 * cls.RADIO_TIERRA_KM * np.arcsin(np.sqrt(a))
+    
+    def buscar_radio(self, lat, lon, radio_km):
+        """Devolver (índices, distancias) de los puntos a menos de radio_km, ordenados"""
+        if not self.celdas:
+            return np.array([], dtype=int), np.array([])
+        
+        # Margen para compensar la distorsión de la proyección
+        x, y = self.proyectar([lat, lon])[0]
+        alcance = radio_km * 1.05
+        cx_min, cy_min = np.floor(np.array([x - alcance, y - alcance]) / self.tamano_celda_km).astype(int)
+        cx_max, cy_max = np.floor(np.array([x + alcance, y + alcance]) / self.tamano_celda_km).astype(int)
+        
+        candidatos = [
+            self.celdas[(cx, cy)]
+            for cx in range(cx_min, cx_max + 1)
+            for cy in range(cy_min, cy_max + 1)
+            if (cx, cy) in self.celdas
+        ]
+        if not candidatos:
+            return np.array([], dtype=int), np.array([])
+        
+        candidatos = np.concatenate(candidatos)
+        distancias = self.distancia_km(lat, lon, self.coordenadas[candidatos])
+        dentro = distancias <= radio_km
+        orden = np.argsort(distancias[dentro])
+        return candidatos[dentro][orden], distancias[dentro][orden]
+    
+    @staticmethod
+    def agrupar(coordenadas, zoom, pixeles_celda=64):
+        """Agrupar puntos en celdas Web Mercator del tamaño correspondiente al zoom"""
+        coordenadas = np.asarray(coordenadas, dtype=float).reshape(-1, 2)
+        if not len(coordenadas):
+            return pd.DataFrame({'lat': np.empty(0), 'lon': np.empty(0), 'cantidad': np.empty(0, dtype=int)})
+        
+        # Coordenadas Web Mercator normalizadas a [0, 1)
+        x = (coordenadas[:, 1] + 180) / 360
+        sen_lat = np.sin(np.radians(coordenadas[:, 0]))
+        y = 0.5 - np.log((1 + sen_lat) / (1 - sen_lat)) / (4 * np.pi)
+        
+        celdas_por_eje = 2 ** zoom * 256 / pixeles_celda
+        claves = np.column_stack([np.floor(x * celdas_por_eje), np.floor(y * celdas_por_eje)]).astype(np.int64)
+        _, inversa = np.unique(claves, axis=0, return_inverse=True)
+        inversa = inversa.ravel()
+        
+        cantidad = np.bincount(inversa)
+        return pd.DataFrame({
+            'lat': np.bincount(inversa, weights=coordenadas[:, 0]) / cantidad,
+            'lon': np.bincount(inversa, weights=coordenadas[:, 1]) / cantidad,
+            'cantidad': cantidad
+        })
+
 class SistemaIncidencias:
-    def __init__(self):
-        self.incidencias = []
+    def __init__(self, directorio_datos='datos'):
+        self.diario = DiarioEventos(directorio_datos)
+        # Todas las sesiones comparten el sistema: cada cambio registra y aplica bajo el mismo bloqueo
+        self.bloqueo = threading.RLock()
+        self.incidencias = self.diario.recuperar()
         self.estaciones_df, self.lineas = self.cargar_estaciones()
+        self.nombres_coordenadas, self.coordenadas_estaciones, self.posiciones_estaciones = self.cargar_coordenadas()
+        self.indice_estaciones = IndiceEspacial(self.coordenadas_estaciones)
+        # Se construye bajo demanda y se invalida al crear o cerrar incidencias
+        self.indice_incidencias = None
         self.sistema_ia = SistemaIA()
         self.tipos_incidencia = [
             "Avería Infraestructura",
@@ -248,6 +531,102 @@ class SistemaIncidencias:
             lineas = ['R1', 'R2', 'R3', 'R4']
             return estaciones_df, lineas
     
+    @staticmethod
+    def normalizar_estacion(nombre):
+        """Normalizar el nombre de una estación (guiones, apóstrofos y espacios)"""
+        nombre = unicodedata.normalize('NFKC', nombre)
+        for guion in ('\u2010', '\u2011', '\u2013', '\u2014'):
+            nombre = nombre.replace(guion, '-')
+        nombre = nombre.replace('\u2019', "'")
+        nombre = ' '.join(nombre.split())
+        return nombre.replace(' - ', '-').replace(' -', '-').replace('- ', '-').lower()
+    
+    def cargar_coordenadas(self, ruta='Estaciones Catalunya coordenadas.csv'):
+        """Cargar coordenadas de estaciones desde el archivo complementario"""
+        try:
+            df = pd.read_csv(ruta, sep=';', encoding='utf-8')
+        except FileNotFoundError:
+            st.warning(f"No se encontró el archivo '{ruta}'; el mapa no mostrará estaciones")
+            return [], np.empty((0, 2)), {}
+        
+        # Las filas con las mismas coordenadas son alias de una misma estación
+        coordenadas, primeras, inversa = np.unique(
+            df[['latitud', 'longitud']].to_numpy(dtype=float),
+            axis=0, return_index=True, return_inverse=True
+        )
+        nombres = [df['estacion'].iloc[i].strip() for i in primeras]
+        posiciones = {
+            self.normalizar_estacion(nombre): int(posicion)
+            for nombre, posicion in zip(df['estacion'], inversa.ravel())
+        }
+        return nombres, coordenadas, posiciones
+    
+    def obtener_coordenadas_estacion(self, estacion):
+        """Obtener (latitud, longitud) de una estación, o None si no se conoce"""
+        posicion = self.posiciones_estaciones.get(self.normalizar_estacion(estacion or ''))
+        if posicion is None:
+            return None
+        return self.coordenadas_estaciones[posicion]
+    
+    def obtener_estaciones_cercanas(self, lat, lon, radio_km):
+        """Obtener las estaciones a menos de radio_km de un punto"""
+        indices, distancias = self.indice_estaciones.buscar_radio(lat, lon, radio_km)
+        return [(self.nombres_coordenadas[i], d) for i, d in zip(indices, distancias)]
+    
+    def obtener_coordenadas_incidencia(self, incidencia):
+        """Situar una incidencia en el punto medio entre sus estaciones A y B"""
+        puntos = [
+            coordenadas for coordenadas in (
+                self.obtener_coordenadas_estacion(incidencia.get('estacion_a')),
+                self.obtener_coordenadas_estacion(incidencia.get('estacion_b'))
+            ) if coordenadas is not None
+        ]
+        if not puntos:
+            return None
+        return np.mean(puntos, axis=0)
+    
+    def obtener_indice_incidencias(self):
+        """Índice espacial de las incidencias activas, reconstruido solo tras un cambio"""
+        with self.bloqueo:
+            if self.indice_incidencias is None:
+                incidencias, coordenadas = [], []
+                for inc in self.obtener_incidencias_activas():
+                    punto = self.obtener_coordenadas_incidencia(inc)
+                    if punto is not None:
+                        incidencias.append(inc)
+                        coordenadas.append(punto)
+                self.indice_incidencias = (incidencias, IndiceEspacial(coordenadas))
+            return self.indice_incidencias
+    
+    def obtener_incidencias_cercanas(self, estacion, radio_km):
+        """Obtener las incidencias activas a menos de radio_km de una estación"""
+        origen = self.obtener_coordenadas_estacion(estacion)
+        if origen is None:
+            return []
+        
+        incidencias, indice = self.obtener_indice_incidencias()
+        indices, distancias = indice.buscar_radio(origen[0], origen[1], radio_km)
+        return [(incidencias[i], d) for i, d in zip(indices, distancias)]
+    
+    def agrupar_mapa(self, zoom, incluir_estaciones=True):
+        """Agrupar incidencias activas (y estaciones) en clusters según el zoom"""
+        escala = 2 ** (12 - zoom)
+        capas = []
+        
+        if incluir_estaciones:
+            estaciones = IndiceEspacial.agrupar(self.coordenadas_estaciones, zoom)
+            estaciones['tamano'] = 60 * escala * np.sqrt(estaciones['cantidad'])
+            estaciones['color'] = '#0055a480'
+            capas.append(estaciones)
+        
+        _, indice = self.obtener_indice_incidencias()
+        incidencias = IndiceEspacial.agrupar(indice.coordenadas, zoom)
+        incidencias['tamano'] = 150 * escala * np.sqrt(incidencias['cantidad'])
+        incidencias['color'] = '#dc3545cc'
+        capas.append(incidencias)
+        
+        return pd.concat(capas, ignore_index=True)
+    
     def obtener_estaciones_por_linea(self, linea):
         """Obtener estaciones para una línea específica"""
         if linea and not self.estaciones_df.empty:
@@ -261,23 +640,69 @@ class SistemaIncidencias:
         return []
     
     def generar_id_incidencia(self):
-        """Generar ID alfanumérico de 6 cifras"""
-        return f"INC{str(uuid.uuid4())[:3].upper()}"
+        """Generar un ID alfanumérico que no use ninguna incidencia existente"""
+        existentes = {inc['id'] for inc in self.incidencias}
+        while True:
+            id_incidencia = f"INC{uuid.uuid4().hex[:6].upper()}"
+            if id_incidencia not in existentes:
+                return id_incidencia
     
-    def agregar_incidencia(self, incidencia):
+    def agregar_incidencia(self, incidencia, usuario=None):
         """Agregar una nueva incidencia"""
-        incidencia['id'] = self.generar_id_incidencia()
-        incidencia['fecha_creacion'] = datetime.now()
-        self.incidencias.append(incidencia)
-        return incidencia['id']
+        with self.bloqueo:
+            incidencia['id'] = self.generar_id_incidencia()
+            incidencia['fecha_creacion'] = datetime.now()
+            evento = self.diario.registrar('incidencia_creada', {'incidencia': incidencia}, usuario)
+            self.diario.aplicar_evento(self.incidencias, evento)
+            self.indice_incidencias = None
+            return incidencia['id']
     
-    def cerrar_incidencia(self, id_incidencia):
+    def cerrar_incidencia(self, id_incidencia, usuario=None):
         """Cerrar una incidencia"""
-        for incidencia in self.incidencias:
-            if incidencia['id'] == id_incidencia:
-                incidencia['hora_final'] = datetime.now().strftime("%H:%M")
-                incidencia['estado'] = 'Cerrada'
-                break
+        with self.bloqueo:
+            for incidencia in self.incidencias:
+                if incidencia['id'] == id_incidencia:
+                    cambios = {
+                        'hora_final': datetime.now().strftime("%H:%M"),
+                        'estado': 'Cerrada'
+                    }
+                    evento = self.diario.registrar('incidencia_cerrada', {'id': id_incidencia, 'cambios': cambios}, usuario)
+                    self.diario.aplicar_evento(self.incidencias, evento)
+                    self.indice_incidencias = None
+                    break
+    
+    def actualizar_prevision(self, id_incidencia, prevision, usuario=None):
+        """Actualizar la previsión de resolución de una incidencia"""
+        with self.bloqueo:
+            for incidencia in self.incidencias:
+                if incidencia['id'] == id_incidencia:
+                    cambios = {'prevision': prevision}
+                    evento = self.diario.registrar('prevision_actualizada', {'id': id_incidencia, 'cambios': cambios}, usuario)
+                    self.diario.aplicar_evento(self.incidencias, evento)
+                    break
+    
+    def registrar_mensajes(self, canal, incidencia, contenido, usuario=None):
+        """Registrar en el diario los mensajes generados por la IA"""
+        with self.bloqueo:
+            self.diario.registrar('mensajes_generados', {
+                'canal': canal,
+                'incidencia': incidencia,
+                'contenido': contenido
+            }, usuario)
+    
+    def confirmar_cambios(self):
+        """Confirmar el lote pendiente del diario y tomar snapshot si corresponde"""
+        with self.bloqueo:
+            self.diario.confirmar()
+            if self.diario.necesita_snapshot():
+                self.diario.tomar_snapshot(self.incidencias)
+    
+    def obtener_incidencias_en(self, instante):
+        """Obtener las incidencias activas en un instante pasado"""
+        with self.bloqueo:
+            self.diario.confirmar()
+        # La lectura del diario se hace fuera del bloqueo para no frenar al resto de sesiones
+        return [inc for inc in self.diario.estado_en(instante) if inc.get('estado') != 'Cerrada']
     
     def obtener_incidencias_activas(self):
         """Obtener incidencias activas"""
@@ -292,6 +717,51 @@ def mostrar_logos():
     </div>
     """, unsafe_allow_html=True)
 
+def mostrar_mapa(sistema):
+    """Mostrar el mapa de incidencias activas agrupadas según el zoom"""
+    st.markdown('<div class="section-header">Mapa de incidencias</div>', unsafe_allow_html=True)
+    
+    col_zoom, col_estaciones = st.columns([3, 1])
+    with col_zoom:
+        zoom = st.slider("Nivel de zoom", min_value=6, max_value=14, value=8, key="zoom_mapa")
+    with col_estaciones:
+        incluir_estaciones = st.checkbox("Mostrar estaciones", value=True, key="mostrar_estaciones")
+    
+    puntos = sistema.agrupar_mapa(zoom, incluir_estaciones)
+    if not puntos.empty:
+        st.map(puntos, latitude='lat', longitude='lon', size='tamano', color='color', zoom=zoom)
+    
+    ubicadas, _ = sistema.obtener_indice_incidencias()
+    sin_ubicar = len(sistema.obtener_incidencias_activas()) - len(ubicadas)
+    if sin_ubicar > 0:
+        st.warning(f"{sin_ubicar} incidencia(s) activa(s) sin coordenadas de estación no se muestran en el mapa.")
+    
+    with st.expander("📍 Búsqueda por proximidad"):
+        col_est, col_radio = st.columns([3, 1])
+        with col_est:
+            estacion = st.selectbox("Estación", sistema.nombres_coordenadas, key="estacion_proximidad")
+        with col_radio:
+            radio_km = st.number_input("Radio (km)", min_value=0.5, value=5.0, step=0.5, key="radio_proximidad")
+        
+        if estacion:
+            cercanas = sistema.obtener_incidencias_cercanas(estacion, radio_km)
+            if cercanas:
+                st.dataframe(pd.DataFrame([{
+                    'ID': inc['id'],
+                    'Tipo de incidencia': inc['tipo'],
+                    'Afectación al Territorio': f"{inc.get('estacion_a', '')} - {inc.get('estacion_b', '')}",
+                    'Distancia (km)': round(distancia, 1)
+                } for inc, distancia in cercanas]), use_container_width=True)
+            else:
+                st.info(f"No hay incidencias activas a menos de {radio_km} km de {estacion}.")
+            
+            lat, lon = sistema.obtener_coordenadas_estacion(estacion)
+            st.caption("Estaciones cercanas: " + ", ".join(
+                f"{nombre} ({distancia:.1f} km)"
+                for nombre, distancia in sistema.obtener_estaciones_cercanas(lat, lon, radio_km)
+                if nombre != estacion
+            ))
+
 def mostrar_dashboard(sistema):
     """Mostrar el dashboard principal con tabla de incidencias"""
     
@@ -307,6 +777,29 @@ def mostrar_dashboard(sistema):
             st.session_state.crear_incidencia = True
             st.rerun()
     
+    # Consulta del estado de la red en un instante pasado
+    with st.expander("🕒 Consultar estado en un instante anterior"):
+        col_fecha, col_hora = st.columns(2)
+        with col_fecha:
+            fecha_consulta = st.date_input("Fecha", value=date.today(), key="fecha_consulta")
+        with col_hora:
+            hora_consulta = st.time_input("Hora", value=dt_time(8, 0), key="hora_consulta")
+        
+        if st.button("🔍 Consultar", key="btn_consulta_instante"):
+            incidencias_pasadas = sistema.obtener_incidencias_en(datetime.combine(fecha_consulta, hora_consulta))
+            if incidencias_pasadas:
+                st.dataframe(pd.DataFrame([{
+                    'ID': inc['id'],
+                    'Tipo de incidencia': inc['tipo'],
+                    'Línea': inc.get('linea', ''),
+                    'Repercusión': inc['repercusion'],
+                    'Previsión de resolución': inc.get('prevision', '')
+                } for inc in incidencias_pasadas]), use_container_width=True)
+            else:
+                st.info("No había incidencias activas en ese instante.")
+    
+    mostrar_mapa(sistema)
+    
     # Mostrar incidencias activas
     incidencias_activas = sistema.obtener_incidencias_activas()
     
@@ -339,6 +832,30 @@ def mostrar_dashboard(sistema):
         
         styled_df = df.style.map(color_por_repercusion, subset=['Repercusión'])
         st.dataframe(styled_df, use_container_width=True, height=400)
+    
+    gestionar_incidencia(sistema, incidencias_activas)
+
+def gestionar_incidencia(sistema, incidencias_activas):
+    """Actualizar la previsión o cerrar una incidencia activa"""
+    st.markdown('<div class="section-header">Gestionar incidencia</div>', unsafe_allow_html=True)
+    
+    opciones = {f"{inc['id']} - {inc['tipo']} ({inc.get('linea', '')})": inc for inc in incidencias_activas}
+    seleccion = st.selectbox("Incidencia", list(opciones), key="incidencia_gestion")
+    incidencia = opciones[seleccion]
+    
+    nueva_prevision = st.text_area("Previsión de resolución", value=incidencia.get('prevision', ''),
+                                   height=80, key=f"prevision_{incidencia['id']}")
+    
+    col_prevision, col_cerrar = st.columns(2)
+    with col_prevision:
+        if st.button("💾 Actualizar previsión", key="btn_actualizar_prevision", use_container_width=True):
+            if nueva_prevision and nueva_prevision != incidencia.get('prevision', ''):
+                sistema.actualizar_prevision(incidencia['id'], nueva_prevision, st.session_state.get('operador'))
+                st.rerun()
+    with col_cerrar:
+        if st.button("✅ Cerrar incidencia", key="btn_cerrar_incidencia", use_container_width=True):
+            sistema.cerrar_incidencia(incidencia['id'], st.session_state.get('operador'))
+            st.rerun()
 
 def procesar_botones_ia(sistema, incidencia_data):
     """Procesar los botones de IA fuera del formulario"""
@@ -353,6 +870,7 @@ def procesar_botones_ia(sistema, incidencia_data):
     with col_btn_copernico:
         if st.button("🤖 Generar IA Copernico", key="btn_copernico", use_container_width=True):
             contenido = sistema.sistema_ia.generar_copernico(incidencia_data)
+            sistema.registrar_mensajes('copernico', incidencia_data, contenido, st.session_state.get('operador'))
             st.session_state.copernico_generado = contenido
             st.rerun()
     
@@ -374,6 +892,7 @@ def procesar_botones_ia(sistema, incidencia_data):
     
     if st.button("🤖 Generar IA SIA Barcelona", key="btn_sia", use_container_width=True):
         contenido = sistema.sistema_ia.generar_sia_barcelona(incidencia_data)
+        sistema.registrar_mensajes('sia_barcelona', incidencia_data, contenido, st.session_state.get('operador'))
         st.session_state.sia_generado = contenido
         st.rerun()
     
@@ -407,6 +926,7 @@ def procesar_botones_ia(sistema, incidencia_data):
     
     if st.button("🤖 Generar IA Plataforma", key="btn_plataforma", use_container_width=True):
         contenido = sistema.sistema_ia.generar_plataforma_embarcada(incidencia_data)
+        sistema.registrar_mensajes('plataforma_embarcada', incidencia_data, contenido, st.session_state.get('operador'))
         st.session_state.plataforma_generado = contenido
         st.rerun()
     
@@ -443,6 +963,7 @@ def procesar_botones_ia(sistema, incidencia_data):
     
     if st.button("🤖 Generar IA Redes Sociales", key="btn_redes", use_container_width=True):
         contenido = sistema.sistema_ia.generar_redes_sociales(incidencia_data)
+        sistema.registrar_mensajes('redes_sociales', incidencia_data, contenido, st.session_state.get('operador'))
         st.session_state.redes_generado = contenido
         st.rerun()
     
@@ -647,7 +1168,7 @@ def crear_incidencia(sistema):
                     nueva_incidencia['dependencia'] = dependencia_opcional
             
             # Guardar incidencia
-            id_incidencia = sistema.agregar_incidencia(nueva_incidencia)
+            id_incidencia = sistema.agregar_incidencia(nueva_incidencia, st.session_state.get('operador'))
             st.success(f"✅ Incidencia {id_incidencia} creada correctamente")
             
             # Limpiar formulario y estados de IA
@@ -664,20 +1185,28 @@ def crear_incidencia(sistema):
         st.session_state.crear_incidencia = False
         st.rerun()
 
+@st.cache_resource
+def obtener_sistema():
+    """Crear el sistema de incidencias una sola vez por proceso"""
+    return SistemaIncidencias()
+
 def main():
     """Función principal de la aplicación"""
     
-    # Inicializar sistema en session_state si no existe
-    if 'sistema' not in st.session_state:
-        st.session_state.sistema = SistemaIncidencias()
+    # Sistema compartido por todas las sesiones del proceso (un único diario)
+    sistema = obtener_sistema()
     
-    sistema = st.session_state.sistema
+    # Operador que firma los cambios registrados en el diario
+    st.sidebar.text_input("Operador", key="operador")
     
-    # Navegación
-    if st.session_state.get('crear_incidencia', False):
-        crear_incidencia(sistema)
-    else:
-        mostrar_dashboard(sistema)
+    # Navegación (los eventos de cada ejecución se confirman en un único lote)
+    try:
+        if st.session_state.get('crear_incidencia', False):
+            crear_incidencia(sistema)
+        else:
+            mostrar_dashboard(sistema)
+    finally:
+        sistema.confirmar_cambios()
 
 if __name__ == "__main__":
     main()